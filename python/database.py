@@ -22,13 +22,22 @@ def read_sql(sql_file):
         return f.read()
 
 
+def _execute(connection, cursor_exec_fn):
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA foreign_keys = TRUE;")
+    return cursor_exec_fn(cursor)
+
+
 def atomic(db_file, cursor_exec_fn):
+    if isinstance(db_file, sqlite3.Connection):
+        # the caller owns this connection, so only commit (or roll back) here
+        with db_file:
+            return _execute(db_file, cursor_exec_fn)
     connection = None
     try:
-        connection = sqlite3.connect(db_file)
-        cursor = connection.cursor()
-        cursor.execute("PRAGMA foreign_keys = TRUE;")
-        results = cursor_exec_fn(cursor)
+        # uri=True lets callers pass "file:" URIs, e.g. shared in-memory databases
+        connection = sqlite3.connect(db_file, uri=True)
+        results = _execute(connection, cursor_exec_fn)
         connection.commit()        
     finally:
         if connection: 
@@ -133,6 +142,26 @@ def find_node(identifier):
     return _find_node
 
 
+def _by_id(results):
+    return {node['id']: node for node in _parse_search_results(results)}
+
+
+def find_nodes_by_ids(identifiers):
+    def _find_nodes(cursor):
+        # the id column is TEXT, so str() matches an identifier the way SQLite does
+        params = f"({', '.join(['?'] * len(identifiers))})"
+        found = dict(cursor.execute(read_sql('search-nodes-by-ids.sql') + params, tuple(identifiers)).fetchall())
+        return {identifier: json.loads(found[str(identifier)])
+                for identifier in identifiers if str(identifier) in found}
+    return _find_nodes
+
+
+def find_all_nodes():
+    def _find_nodes(cursor):
+        return _by_id(cursor.execute(read_sql('search-all-nodes.sql')).fetchall())
+    return _find_nodes
+
+
 def _search_where(properties, predicate='='):
     return " AND ".join([f"json_extract(body, '$.{key}') {predicate} ?" for key in properties.keys()])
 
@@ -2,11 +2,30 @@ import sqlite3
 
 import pytest
 import json
+import uuid
+from functools import partial
 from pathlib import Path
-from filecmp import cmp
-from stat import S_ISREG
 import database as db
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+
+# durability is irrelevant for the throwaway on-disk template, so trade it for speed;
+# journal_mode is stored in the file, synchronous lasts for the populating connection
+TEST_PRAGMAS = ["PRAGMA journal_mode = WAL;",
+                "PRAGMA synchronous = NORMAL;"]
+
+
+def _with_test_pragmas(cursor_exec_fn):
+    def _exec(cursor):
+        for pragma in TEST_PRAGMAS:
+            cursor.execute(pragma)
+        return cursor_exec_fn(cursor)
+    return _exec
+
 
 @pytest.fixture()
 def database_test_file(tmp_path):
@@ -15,7 +34,62 @@ def database_test_file(tmp_path):
     return d / "apple.sqlite"
 
 
+@pytest.fixture(scope="session")
+def worker_id(request):
+    # matches pytest-xdist's fixture of the same name, without requiring the plugin
+    return getattr(request.config, "workerinput", {}).get("workerid", "master")
+
+
 @pytest.fixture()
+def memory_db(worker_id):
+    uri = f"file:simplegraph_{worker_id}_{uuid.uuid4().hex}?mode=memory&cache=shared"
+    # a shared in-memory database only lives as long as a connection to it
+    keeper = sqlite3.connect(uri, uri=True)
+    yield uri
+    keeper.close()
+
+
+@pytest.fixture()
+def connection(memory_db):
+    conn = sqlite3.connect(memory_db, uri=True)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture()
+def db_conn(connection):
+    # db.atomic bound to one connection held open for the whole test
+    return partial(db.atomic, connection)
+
+
+def _canon_json(value):
+    # canonical json strings compare equal regardless of key order
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+def _canon(results):
+    return [(x, y, _canon_json(_json_loads(z))) for (x, y, z) in results]
+
+
+def _edge_lists(edges):
+    # flatten the edges fixture into the parallel lists connect_many_nodes expects
+    sources = []
+    targets = []
+    properties = []
+    for src, tgts in edges.items():
+        for target in tgts:
+            tgt, label = target
+            sources.append(src)
+            targets.append(tgt)
+            properties.append(label if label else {})
+    return sources, targets, properties
+
+
+def _file_eq(actual, expected):
+    return Path(actual).read_bytes() == Path(expected).read_bytes()
+
+
+@pytest.fixture(scope="session")
 def nodes():
     return {
         1: {'name': 'Apple Computer Company', 'type': ['company', 'start-up'], 'founded': 'April 1, 1976'},
@@ -26,7 +100,13 @@ def nodes():
     }
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
+def stored_nodes(nodes):
+    # the bodies as saved, with the identifier written into each one
+    return {id: {**body, 'id': id} for id, body in nodes.items()}
+
+
+@pytest.fixture(scope="session")
 def edges():
     return {
         1: [(4, {'action': 'divested', 'amount': 800, 'date': 'April 12, 1976'})],
@@ -37,82 +117,83 @@ def edges():
     }
 
 
+@pytest.fixture(scope="session")
+def apple_template(tmp_path_factory, nodes, edges):
+    template = tmp_path_factory.mktemp("simplegraph") / "apple_template.sqlite"
+    db.initialize(template)
+    sources, targets, properties = _edge_lists(edges)
+
+    # every insert shares one transaction, so there is a single commit
+    def _populate(cursor):
+        # add_nodes writes the id into each body, so keep the shared fixture untouched
+        db.add_nodes([dict(body) for body in nodes.values()], list(nodes.keys()))(cursor)
+        db.connect_many_nodes(sources, targets, properties)(cursor)
+    db.atomic(template, _with_test_pragmas(_populate))
+    return template
+
+
 @pytest.fixture()
-def apple(database_test_file, nodes, edges):
-    db.initialize(database_test_file)
-    [db.atomic(database_test_file, db.add_node(node, id))
-     for id, node in nodes.items()]
-    for src, targets in edges.items():
-        for target in targets:
-            tgt, label = target
-            if label:
-                db.atomic(database_test_file,
-                          db.connect_nodes(src, tgt, label))
-            else:
-                db.atomic(database_test_file, db.connect_nodes(src, tgt))
+def apple(apple_template, connection):
+    # each test gets its own in-memory copy of the database built once per session
+    source = sqlite3.connect(apple_template)
+    try:
+        source.backup(connection)
+    finally:
+        source.close()
     yield
 
 
-def test_initialize(database_test_file, apple):
-    assert database_test_file.exists()
-    assert S_ISREG(database_test_file.stat().st_mode)
+@pytest.fixture(scope="session")
+def apple_connection(apple_template):
+    # one in-memory copy shared by the read-only tests for the whole session
+    conn = sqlite3.connect(":memory:")
+    source = sqlite3.connect(apple_template)
+    try:
+        source.backup(conn)
+    finally:
+        source.close()
+    yield conn
+    conn.close()
 
 
-def test_bulk_operations(database_test_file, nodes, edges):
+def test_initialize(database_test_file):
     db.initialize(database_test_file)
+    assert database_test_file.is_file()
+
+
+def test_bulk_operations(connection, db_conn, nodes, stored_nodes, edges):
+    db.initialize(connection)
     ids = []
     bodies = []
     for id, body in nodes.items():
         ids.append(id)
-        bodies.append(body)
+        bodies.append(dict(body))
 
     # bulk add and confirm
-    db.atomic(database_test_file, db.add_nodes(bodies, ids))
-    for id, node in nodes.items():
-        assert db.atomic(database_test_file, db.find_node(id)) == node
+    db_conn(db.add_nodes(bodies, ids))
+    assert db_conn(db.find_nodes_by_ids(ids)) == stored_nodes
 
     # bulk upsert and confirm
-    db.atomic(database_test_file, db.upsert_nodes(bodies, ids))
-    for id, node in nodes.items():
-        assert db.atomic(database_test_file, db.find_node(id)) == node
+    db_conn(db.upsert_nodes(bodies, ids))
+    assert db_conn(db.find_nodes_by_ids(ids)) == stored_nodes
 
     # bulk connect and confirm
-    sources = []
-    targets = []
-    properties = []
+    sources, targets, properties = _edge_lists(edges)
+    db_conn(db.connect_many_nodes(sources, targets, properties))
     for src, tgts in edges.items():
-        for target in tgts:
-            tgt, label = target
-            sources.append(src)
-            targets.append(tgt)
-            if label:
-                properties.append(label)
-            else:
-                properties.append({})
-
-    db.atomic(database_test_file, db.connect_many_nodes(
-        sources, targets, properties))
-    for src, tgts in edges.items():
-        actual = [tuple(x) for x in [[edge[0], edge[1], json.loads(edge[2])]
-                                     for edge in db.atomic(database_test_file, db.get_connections_one_way(src))]]
-        for target in tgts:
-            tgt, label = target
-            if label:
-                expected = (str(src), str(tgt), label)
-            else:
-                expected = (str(src), str(tgt), {})
-            assert expected in actual
+        actual = set(_canon(db_conn(db.get_connections_one_way(src))))
+        for tgt, label in tgts:
+            assert (str(src), str(tgt), _canon_json(label if label else {})) in actual
 
     # bulk remove and confirm
-    db.atomic(database_test_file, db.remove_nodes(ids))
-    for id in ids:
-        assert db.atomic(database_test_file, db.find_node(id)) == {}
+    db_conn(db.remove_nodes(ids))
+    assert db_conn(db.find_nodes_by_ids(ids)) == {}
 
 
-def test_exception(database_test_file, apple, nodes):
+def test_exception(apple, db_conn, nodes):
     node_id = 1
     try:
-        db.atomic(database_test_file, db.add_node(nodes[node_id], node_id))
+        db_conn(db.add_node(dict(nodes[node_id]), node_id))
     except sqlite3.IntegrityError as e: # should be thrown since we are inserting a duplicate node
         assert 'UNIQUE constraint failed: nodes.id' in e.args
 
@@ -120,114 +201,115 @@ def test_exception(database_test_file, apple, nodes):
     new_node = {'name': 'Tim Cook', 'type': ['person', 'CEO']}
     new_node_id = 6
     try:
-        db.atomic(database_test_file, db.add_node(new_node, new_node_id))
+        db_conn(db.add_node(new_node, new_node_id))
     except Exception as e:
         assert False
 
 
 
-def test_search(database_test_file, apple, nodes):
-    for id, node in nodes.items():
-        assert db.atomic(database_test_file, db.find_node(id)) == node
-    steves = db.atomic(database_test_file, db.find_nodes(
+def test_search(apple, db_conn, stored_nodes):
+    assert db_conn(db.find_node(1)) == stored_nodes[1]
+    assert db_conn(db.find_all_nodes()) == stored_nodes
+    # results are keyed by the identifiers as requested, whatever type was stored
+    assert db_conn(db.find_nodes_by_ids(['1', 3])) == {
+        '1': stored_nodes[1], 3: stored_nodes['3']}
+    steves = db_conn(db.find_nodes(
         {'name': 'Steve'}, db._search_like, db._search_starts_with))
     assert len(steves) == 2
     assert list(map(lambda x: x['name'], steves)) == [
         'Steve Wozniak', 'Steve Jobs']
 
 
-def test_traversal(database_test_file, apple):
+TRAVERSALS = [
     # the traversal CTE seed type is respected, and appears in the output as-is
-    assert db.traverse(database_test_file, 2, 3) == [2, '1', '3']
+    (2, 3, db.find_neighbors, [2, '1', '3']),
     # singly-quoted strings works as expected
-    assert db.traverse(database_test_file, '2', '3') == [
-        '2', '1', '3', '4', '5']
+    ('2', '3', db.find_neighbors, ['2', '1', '3', '4', '5']),
     # and so do doubly-quoted values (in the prior version, these produced empty lists)
-    assert db.traverse(database_test_file, "2", "3") == [
-        '2', '1', '3', '4', '5']
+    ("2", "3", db.find_neighbors, ['2', '1', '3', '4', '5']),
 
     # more test sets of this pattern:
     # since int is a different type than string, it can appear twice in the output
-    assert db.traverse(database_test_file, 4, 5) == [
-        4, '1', '2', '3', '4', '5']
-    assert db.traverse(database_test_file, '4', '5') == [
-        '4', '1', '2', '3', '5']
-    assert db.traverse(database_test_file, "4", "5") == [
-        '4', '1', '2', '3', '5']
-
-    assert db.traverse(database_test_file, 5,
-                       neighbors_fn=db.find_inbound_neighbors) == [5]
-    assert db.traverse(database_test_file, '5',
-                       neighbors_fn=db.find_inbound_neighbors) == ['5']
-    assert db.traverse(database_test_file, 5,
-                       neighbors_fn=db.find_outbound_neighbors) == [5, '1', '4']
-    assert db.traverse(database_test_file, '5',
-                       neighbors_fn=db.find_outbound_neighbors) == ['5', '1', '4']
-    assert db.traverse(database_test_file, 5, neighbors_fn=db.find_neighbors) == [
-        5, '1', '2', '3', '4', '5']
-    assert db.traverse(database_test_file, '5', neighbors_fn=db.find_neighbors) == [
-        '5', '1', '2', '3', '4']
-    assert db.traverse(database_test_file, "5", neighbors_fn=db.find_neighbors) == [
-        '5', '1', '2', '3', '4']
-
-
-def test_traversal_with_bodies(database_test_file, apple):
-    def _normalize_results(results):
-        return [(x, y, json.loads(z)) for (x, y, z) in results]
-
-    assert _normalize_results(db.traverse_with_bodies(database_test_file, 2, 3)) == _normalize_results(
-        [('2', '()', '{"name":"Steve Wozniak","type":["person","engineer","founder"],"id":2}'),
-         ('1', '->', '{"action":"founded"}'), ('3', '->', '{}'), (
-         '1', '()', '{"name":"Apple Computer Company","type":["company","start-up"],"founded":"April 1, 1976","id":1}'),
-         (
-             '2', '<-', '{"action":"founded"}'), ('3', '<-', '{"action":"founded"}'),
-         ('4', '<-', '{"action":"founded"}'), ('5', '<-', '{"action":"invested","equity":80000,"debt":170000}'),
-         ('4', '->', '{"action":"divested","amount":800,"date":"April 12, 1976"}'),
-         ('3', '()', '{"name":"Steve Jobs","type":["person","designer","founder"],"id":"3"}')])
-    assert _normalize_results(
-        db.traverse_with_bodies(database_test_file, 5, neighbors_fn=db.find_inbound_neighbors)) == _normalize_results(
-        [('5', '()', '{"name":"Mike Markkula","type":["person","investor"],"id":5}')])
-    assert _normalize_results(
-        db.traverse_with_bodies(database_test_file, 5, neighbors_fn=db.find_outbound_neighbors)) == _normalize_results(
-        [('5', '()', '{"name":"Mike Markkula","type":["person","investor"],"id":5}'),
-         ('1', '->', '{"action":"invested","equity":80000,"debt":170000}'), (
-             '1', '()',
-             '{"name":"Apple Computer Company","type":["company","start-up"],"founded":"April 1, 1976","id":1}'),
-         ('4', '->', '{"action":"divested","amount":800,"date":"April 12, 1976"}'),
-         ('4', '()', '{"name":"Ronald Wayne","type":["person","administrator","founder"],"id":4}'),
-         ('1', '->', '{"action":"founded"}')])
-    assert _normalize_results(
-        db.traverse_with_bodies(database_test_file, 5, neighbors_fn=db.find_neighbors)) == _normalize_results(
-        [('5', '()', '{"name":"Mike Markkula","type":["person","investor"],"id":5}'),
-         ('1', '->', '{"action":"invested","equity":80000,"debt":170000}'), (
-         '1', '()', '{"name":"Apple Computer Company","type":["company","start-up"],"founded":"April 1, 1976","id":1}'),
-         ('2', '<-', '{"action":"founded"}'), ('3', '<-', '{"action":"founded"}'), ('4', '<-', '{"action":"founded"}'),
-         (
-             '5', '<-', '{"action":"invested","equity":80000,"debt":170000}'),
-         ('4', '->', '{"action":"divested","amount":800,"date":"April 12, 1976"}'),
-         ('2', '()', '{"name":"Steve Wozniak","type":["person","engineer","founder"],"id":2}'),
-         ('1', '->', '{"action":"founded"}'), ('3', '->', '{}'),
-         ('3', '()', '{"name":"Steve Jobs","type":["person","designer","founder"],"id":"3"}'), ('2', '<-', '{}'),
-         ('4', '()', '{"name":"Ronald Wayne","type":["person","administrator","founder"],"id":4}'),
-         ('1', '<-', '{"action":"divested","amount":800,"date":"April 12, 1976"}')])
-
-
-def test_visualization(database_test_file, apple, tmp_path):
+    (4, 5, db.find_neighbors, [4, '1', '2', '3', '4', '5']),
+    ('4', '5', db.find_neighbors, ['4', '1', '2', '3', '5']),
+    ("4", "5", db.find_neighbors, ['4', '1', '2', '3', '5']),
+
+    (5, None, db.find_inbound_neighbors, [5]),
+    ('5', None, db.find_inbound_neighbors, ['5']),
+    (5, None, db.find_outbound_neighbors, [5, '1', '4']),
+    ('5', None, db.find_outbound_neighbors, ['5', '1', '4']),
+    (5, None, db.find_neighbors, [5, '1', '2', '3', '4', '5']),
+    ('5', None, db.find_neighbors, ['5', '1', '2', '3', '4']),
+    ("5", None, db.find_neighbors, ['5', '1', '2', '3', '4']),
+]
+
+
+@pytest.mark.parametrize("seed, terminal, fn, expected", TRAVERSALS)
+def test_traversal(apple_connection, seed, terminal, fn, expected):
+    assert db.traverse(apple_connection, seed, terminal, neighbors_fn=fn) == expected
+
+
+# expected paths depend only on the apple graph, so they are canonicalized once at import
+EXPECTED_TRAVERSE_2_3 = _canon(
+    [('2', '()', '{"name":"Steve Wozniak","type":["person","engineer","founder"],"id":2}'),
+     ('1', '->', '{"action":"founded"}'), ('3', '->', '{}'),
+     ('1', '()', '{"name":"Apple Computer Company","type":["company","start-up"],"founded":"April 1, 1976","id":1}'),
+     ('2', '<-', '{"action":"founded"}'), ('3', '<-', '{"action":"founded"}'),
+     ('4', '<-', '{"action":"founded"}'), ('5', '<-', '{"action":"invested","equity":80000,"debt":170000}'),
+     ('4', '->', '{"action":"divested","amount":800,"date":"April 12, 1976"}'),
+     ('3', '()', '{"name":"Steve Jobs","type":["person","designer","founder"],"id":"3"}')])
+
+EXPECTED_INBOUND_5 = _canon(
+    [('5', '()', '{"name":"Mike Markkula","type":["person","investor"],"id":5}')])
+
+EXPECTED_OUTBOUND_5 = _canon(
+    [('5', '()', '{"name":"Mike Markkula","type":["person","investor"],"id":5}'),
+     ('1', '->', '{"action":"invested","equity":80000,"debt":170000}'),
+     ('1', '()', '{"name":"Apple Computer Company","type":["company","start-up"],"founded":"April 1, 1976","id":1}'),
+     ('4', '->', '{"action":"divested","amount":800,"date":"April 12, 1976"}'),
+     ('4', '()', '{"name":"Ronald Wayne","type":["person","administrator","founder"],"id":4}'),
+     ('1', '->', '{"action":"founded"}')])
+
+EXPECTED_NEIGHBORS_5 = _canon(
+    [('5', '()', '{"name":"Mike Markkula","type":["person","investor"],"id":5}'),
+     ('1', '->', '{"action":"invested","equity":80000,"debt":170000}'),
+     ('1', '()', '{"name":"Apple Computer Company","type":["company","start-up"],"founded":"April 1, 1976","id":1}'),
+     ('2', '<-', '{"action":"founded"}'), ('3', '<-', '{"action":"founded"}'), ('4', '<-', '{"action":"founded"}'),
+     ('5', '<-', '{"action":"invested","equity":80000,"debt":170000}'),
+     ('4', '->', '{"action":"divested","amount":800,"date":"April 12, 1976"}'),
+     ('2', '()', '{"name":"Steve Wozniak","type":["person","engineer","founder"],"id":2}'),
+     ('1', '->', '{"action":"founded"}'), ('3', '->', '{}'),
+     ('3', '()', '{"name":"Steve Jobs","type":["person","designer","founder"],"id":"3"}'), ('2', '<-', '{}'),
+     ('4', '()', '{"name":"Ronald Wayne","type":["person","administrator","founder"],"id":4}'),
+     ('1', '<-', '{"action":"divested","amount":800,"date":"April 12, 1976"}')])
+
+
+def test_traversal_with_bodies(apple_connection):
+    assert _canon(db.traverse_with_bodies(apple_connection, 2, 3)) == EXPECTED_TRAVERSE_2_3
+    assert _canon(db.traverse_with_bodies(
+        apple_connection, 5, neighbors_fn=db.find_inbound_neighbors)) == EXPECTED_INBOUND_5
+    assert _canon(db.traverse_with_bodies(
+        apple_connection, 5, neighbors_fn=db.find_outbound_neighbors)) == EXPECTED_OUTBOUND_5
+    assert _canon(db.traverse_with_bodies(
+        apple_connection, 5, neighbors_fn=db.find_neighbors)) == EXPECTED_NEIGHBORS_5
+
+
+def test_visualization(memory_db, apple, tmp_path):
     dot_raw = tmp_path / "apple-raw.dot"
-    db.visualize(database_test_file, dot_raw, [4, 1, 5])
-    assert cmp(dot_raw, Path.cwd() / ".." / ".examples" / "apple-raw.dot")
+    db.visualize(memory_db, dot_raw, [4, 1, 5])
+    assert _file_eq(dot_raw, Path.cwd() / ".." / ".examples" / "apple-raw.dot")
     dot = tmp_path / "apple.dot"
-    db.visualize(database_test_file, dot, [4, 1, 5], exclude_node_keys=[
+    db.visualize(memory_db, dot, [4, 1, 5], exclude_node_keys=[
         'type'], hide_edge_key=True)
-    assert cmp(dot, Path.cwd() / ".." / ".examples" / "apple.dot")
+    assert _file_eq(dot, Path.cwd() / ".." / ".examples" / "apple.dot")
 
 
-def test_visualize_bodies(database_test_file, apple, tmp_path):
+def test_visualize_bodies(memory_db, apple, tmp_path):
     dot_raw = tmp_path / "apple-raw.dot"
-    path_with_bodies = db.traverse_with_bodies(database_test_file, 4, 5)
+    path_with_bodies = db.traverse_with_bodies(memory_db, 4, 5)
     db.visualize_bodies(dot_raw, path_with_bodies)
-    assert cmp(dot_raw, Path.cwd() / ".." / ".examples" / "apple-raw.dot")
+    assert _file_eq(dot_raw, Path.cwd() / ".." / ".examples" / "apple-raw.dot")
     dot = tmp_path / "apple.dot"
     db.visualize_bodies(dot, path_with_bodies, exclude_node_keys=[
         'type'], hide_edge_key=True)
-    assert cmp(dot, Path.cwd() / ".." / ".examples" / "apple.dot")
+    assert _file_eq(dot, Path.cwd() / ".." / ".examples" / "apple.dot")
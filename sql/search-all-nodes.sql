@@ -0,0 +1 @@
+SELECT body FROM nodes
\ No newline at end of file
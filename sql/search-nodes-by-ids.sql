@@ -0,0 +1 @@
+SELECT id, body FROM nodes WHERE id IN 
\ No newline at end of file